@@ -25,31 +25,41 @@ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import argparse
-import io
+import difflib
+import email.utils
+import hashlib
 import ipaddress
 import json
 import logging
 import os
 import re
+import secrets
 import shlex
 import stat
 import subprocess
 import sys
 import xml.etree.cElementTree as ET
-from contextlib import redirect_stdout
-from dataclasses import dataclass
-from datetime import datetime, timezone
-from tempfile import mkstemp
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from typing import Dict, List, Optional
 
 import requests
+import requests.adapters
 import voluptuous as vol
 import voluptuous.humanize
 import yaml
 from requests.exceptions import ConnectionError
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 IP_ADDRESS = ipaddress.ip_address
-DOMAIN_NAME = vol.Any(vol.Match(r"\w+"), vol.Match(vol.DOMAIN_REGEX))
+DOMAIN_NAME = vol.Match(
+    re.compile(rf"(?:[\w-]+|{vol.DOMAIN_REGEX.pattern})\Z", vol.DOMAIN_REGEX.flags),
+    msg="expected a domain name",
+)
 
 CONFIG_SCHEMA = vol.Schema(
     {
@@ -60,35 +70,35 @@ CONFIG_SCHEMA = vol.Schema(
         "zonefiles": bool,
         "template": str,
         "acl": str,
-        vol.Required("peers"): vol.Schema(
-            {
-                str: vol.Schema(
-                    {
-                        vol.Required("source"): vol.FqdnUrl,
-                        vol.Required("format"): vol.Any("xml", "json"),
-                    }
-                ),
-            }
-        ),
+        vol.Required("peers"): {
+            str: {
+                vol.Required("source"): vol.FqdnUrl,
+                vol.Required("format"): vol.Any("xml", "json"),
+            },
+        },
         "reconfigure_command": str,
     }
 )
 
 DYNAMIC_CONFIG_SCHEMA = vol.Schema(
     {
-        vol.Required("masters"): vol.Schema(
-            [
-                {
-                    vol.Required("ip"): IP_ADDRESS,
-                    vol.Required("tsig"): DOMAIN_NAME,
-                }
-            ]
-        ),
-        vol.Required("zones"): vol.Schema([DOMAIN_NAME]),
+        vol.Required("masters"): [
+            {
+                vol.Required("ip"): IP_ADDRESS,
+                vol.Required("tsig"): DOMAIN_NAME,
+            }
+        ],
+        vol.Required("zones"): [DOMAIN_NAME],
     }
 )
 
+CONTROL_CHARACTERS = re.compile(r"[\x00-\x1f\x7f]")
+
 REQUESTS_TIMEOUT = (5, 30)
+MAX_WORKERS = 16
+
+# bump when parsing or normalisation of dynamic configs changes
+PARSED_CACHE_VERSION = 1
 
 logger = logging.getLogger(__name__)
 
@@ -106,76 +116,107 @@ class Peer(object):
     zones: List[str]
 
 
+@dataclass(frozen=True)
+class ParsedCache(object):
+    digest: str
+    signature: List[int]
+    peers: List[Peer]
+
+
 def parse_dynamic_config_dict(peer_id: str, config: dict) -> Peer:
-    voluptuous.humanize.validate_with_humanized_errors(config, DYNAMIC_CONFIG_SCHEMA)
+    try:
+        DYNAMIC_CONFIG_SCHEMA(config)
+    except vol.Invalid as exc:
+        raise vol.Error(voluptuous.humanize.humanize_error(config, exc)) from exc
     masters = [
         PeerMaster(ip=master["ip"], tsig=master["tsig"]) for master in config["masters"]
     ]
-    zones = [re.sub(r"\.$", "", z) for z in config["zones"]]
+    zones = [z.rstrip(".") for z in config["zones"]]
     logger.debug("Dynamic config for peer %s OK, %d zones", peer_id, len(zones))
     return Peer(id=peer_id, masters=masters, zones=zones)
 
 
-def parse_dynamic_config_json(peer_id: str, data: str) -> List[Peer]:
+def parse_dynamic_config_json(peer_id: str, data: bytes) -> List[Peer]:
     logger.debug("Reading dynamic config for peer %s as JSON", peer_id)
     config = json.loads(data)
     return [parse_dynamic_config_dict(peer_id, config)]
 
 
-def parse_dynamic_config_xml(peer_id: str, data: str) -> List[Peer]:
+def parse_dynamic_config_xml(peer_id: str, data: bytes) -> List[Peer]:
     logger.debug("Reading dynamic config for peer %s as XML", peer_id)
     peers = []
     xml_root = ET.fromstring(data)
-    for peer in xml_root.findall("./peer"):
+    for peer in xml_root:
+        if peer.tag != "peer":
+            continue
         masters = []
         zones = []
         name = peer.attrib["name"]
-        for p in peer.findall("./primary"):
-            masters.append({"ip": p.text, "tsig": p.attrib["tsig"]})
-        for z in peer.findall("./zone"):
-            zones.append(z.text)
+        for child in peer:
+            if child.tag == "primary":
+                masters.append({"ip": child.text, "tsig": child.attrib["tsig"]})
+            elif child.tag == "zone":
+                zones.append(child.text)
         config = {"masters": masters, "zones": zones}
         peers.append(parse_dynamic_config_dict(peer_id + "/" + name, config))
     return peers
 
 
+def parse_dynamic_config(peer_id: str, data: bytes, payload_format: str) -> List[Peer]:
+    if payload_format == "json":
+        return parse_dynamic_config_json(peer_id, data)
+    elif payload_format == "xml":
+        return parse_dynamic_config_xml(peer_id, data)
+    else:
+        raise ValueError("Invalid format: " + payload_format)
+
+
 def check_peers(peers: List[Peer]):
     all_zones: Dict[str, str] = {}
     zone_errors = 0
     for peer in peers:
         for zone in peer.zones:
-            if zone in all_zones:
+            # setdefault only grows the dict when the zone was not seen before
+            known_zones = len(all_zones)
+            owner = all_zones.setdefault(zone, peer.id)
+            if len(all_zones) == known_zones:
                 logger.critical(
-                    "zone %s defined by both %s and %s", zone, all_zones[zone], peer.id
+                    "zone %s defined by both %s and %s", zone, owner, peer.id
                 )
                 zone_errors += 1
-            else:
-                all_zones[zone] = peer.id
     if zone_errors > 0:
         raise ValueError("Duplicate zones")
 
 
 def zone2file(zone: str) -> str:
-    return re.sub(r"/", "-", zone.lower())
+    return zone.lower().replace("/", "-")
 
 
-def generate_nsd(peers: List[Peer], use_zonefiles: bool = False):
+def generate_nsd(peers: List[Peer], out: List[str], use_zonefiles: bool = False):
     for peer in peers:
+        # the peer header and master statements are identical for every zone
+        header = f"# {peer.id}\nzone:\n"
+        masters = []
+        for m in peer.masters:
+            notify = f"{m.ip} {m.tsig}"
+            masters.append(f"  allow-notify: {notify}\n")
+            masters.append(f"  allow-notify: {m.ip} NOKEY\n")
+            masters.append(f"  request-xfr: {notify}\n")
+        masters.append("\n")
+        footer = "".join(masters)
         for z in peer.zones:
-            print(f"# {peer.id}")
-            print("zone:")
-            print(f"  name: {z}")
+            out.append(header)
+            out.append(f"  name: {z}\n")
             if use_zonefiles:
-                print(f"  zonefile: {zone2file(z)}")
-            for m in peer.masters:
-                print(f"  allow-notify: {m.ip} {m.tsig}")
-                print(f"  allow-notify: {m.ip} NOKEY")
-                print(f"  request-xfr: {m.ip} {m.tsig}")
-            print("")
+                out.append(f"  zonefile: {zone2file(z)}\n")
+            out.append(footer)
 
 
 def generate_knot(
-    peers: List[Peer], template: Optional[str] = None, acl: Optional[str] = None
+    peers: List[Peer],
+    out: List[str],
+    template: Optional[str] = None,
+    acl: Optional[str] = None,
 ):
 
     for peer in peers:
@@ -183,39 +224,47 @@ def generate_knot(
         masters = []
         acls = [acl] if acl else []
         n = 1
-        print("remote:")
+        out.append("remote:\n")
         for m in peer.masters:
             remote = f"{peer.id}/{n}"
             n += 1
-            print("  - id:", remote)
-            print("    address:", m.ip)
+            out.append(f"  - id: {remote}\n")
+            out.append(f"    address: {m.ip}\n")
             if m.tsig:
-                print("    key:", m.tsig)
+                out.append(f"    key: {m.tsig}\n")
             masters.append(remote)
 
-        print("acl:")
+        out.append("acl:\n")
         for m in masters:
-            print("  - id:", m)
-            print("    remote:", m)
-            print("    action: [notify,transfer]")
+            out.append(f"  - id: {m}\n")
+            out.append(f"    remote: {m}\n")
+            out.append("    action: [notify,transfer]\n")
             acls.append(remote)
 
-        print("zone:")
+        zone_template = f"    template: {template}\n" if template else ""
+        zone_footer = (
+            f"{zone_template}"
+            f"    master: [{','.join(masters)}]\n"
+            f"    acl: [{','.join(acls)}]\n"
+        )
+        out.append("zone:\n")
         for z in peer.zones:
-            print("  - domain:", z)
-            if template:
-                print("    template:", template)
-            print("    master:", "[" + ",".join(masters) + "]")
-            print("    acl:", "[" + ",".join(acls) + "]")
+            out.append(f"  - domain: {z}\n")
+            out.append(zone_footer)
 
 
 def get_unless_modified(
-    url: str, modified: Optional[datetime]
+    session: requests.Session,
+    url: str,
+    modified: Optional[str],
+    etag: Optional[str] = None,
 ) -> Optional[requests.Response]:
     headers = {}
     if modified is not None:
-        headers["If-Modified-Since"] = modified.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    response = requests.get(url, headers=headers, timeout=REQUESTS_TIMEOUT)
+        headers["If-Modified-Since"] = modified
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    response = session.get(url, headers=headers, timeout=REQUESTS_TIMEOUT)
     logger.debug("GET %s returned %d", url, response.status_code)
     if response.status_code == 304:
         logger.debug("%s not modified since %s", url, modified)
@@ -223,46 +272,148 @@ def get_unless_modified(
     return response
 
 
+def read_cache(filename: str) -> Optional[bytes]:
+    try:
+        with open(filename, "rb") as cache_file:
+            return cache_file.read()
+    except FileNotFoundError:
+        return None
+
+
+def cache_signature(filename: str) -> List[int]:
+    st = os.stat(filename)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def plain_string(value: str) -> str:
+    """Reject anything that could break out of a line in the generated config"""
+    if not isinstance(value, str) or CONTROL_CHARACTERS.search(value):
+        raise ValueError(f"unexpected value {value!r}")
+    return value
+
+
+def load_parsed_cache(filename: str) -> Optional[ParsedCache]:
+    data = read_cache(filename)
+    if data is None:
+        return None
+    try:
+        parsed = json.loads(data)
+        if parsed["version"] != PARSED_CACHE_VERSION:
+            return None
+        peers = [
+            Peer(
+                id=plain_string(peer["id"]),
+                masters=[
+                    PeerMaster(
+                        ip=plain_string(master["ip"]),
+                        tsig=plain_string(master["tsig"]),
+                    )
+                    for master in peer["masters"]
+                ],
+                zones=[plain_string(zone) for zone in peer["zones"]],
+            )
+            for peer in parsed["peers"]
+        ]
+        return ParsedCache(
+            digest=parsed["digest"], signature=parsed["signature"], peers=peers
+        )
+    except (ValueError, KeyError, TypeError) as exc:
+        logger.warning("Ignoring invalid parsed cache %s: %s", filename, str(exc))
+        return None
+
+
+def save_parsed_cache(filename: str, parsed_cache: ParsedCache) -> None:
+    parsed = {
+        "version": PARSED_CACHE_VERSION,
+        "digest": parsed_cache.digest,
+        "signature": parsed_cache.signature,
+        "peers": [asdict(peer) for peer in parsed_cache.peers],
+    }
+    with open(filename, "wt") as cache_file:
+        json.dump(parsed, cache_file)
+
+
 def process_dper(
+    session: requests.Session,
     peer_id: str,
     source: str,
     cache: Optional[str],
     force_cache: bool,
     payload_format: str,
 ) -> List[Peer]:
-    if cache is not None:
-        modified: Optional[datetime] = None
-        try:
-            modified = datetime.fromtimestamp(os.stat(cache).st_mtime, tz=timezone.utc)
-        except FileNotFoundError:
-            pass
-
-        try:
-            response = None if force_cache else get_unless_modified(source, modified)
-        except ConnectionError as exc:
-            logger.error("Connection to %s failed: %s", peer_id, str(exc))
-            logger.warning("Reverting to cached data for %s", peer_id)
-            response = None
-
-        if response is None:
-            with open(cache, "rt") as cache_file:
-                payload = cache_file.read()
-        else:
-            response.raise_for_status()
-            payload = response.text
-            with open(cache, "wt") as cache_file:
-                cache_file.write(payload)
+    if cache is None:
+        response = session.get(source, timeout=REQUESTS_TIMEOUT)
+        response.raise_for_status()
+        return parse_dynamic_config(peer_id, response.content, payload_format)
+
+    etag_cache = cache + ".etag"
+    parsed_cache_file = cache + ".parsed"
+    modified: Optional[str] = None
+    etag: Optional[str] = None
+    parsed_cache: Optional[ParsedCache] = None
+    signature: Optional[List[int]] = None
+    try:
+        signature = cache_signature(cache)
+        modified = email.utils.formatdate(signature[0] / 1e9, usegmt=True)
+        cached_etag = read_cache(etag_cache)
+        if cached_etag:
+            etag = cached_etag.decode()
+        parsed_cache = load_parsed_cache(parsed_cache_file)
+    except FileNotFoundError:
+        pass
+
+    try:
+        response = (
+            None
+            if force_cache
+            else get_unless_modified(session, source, modified, etag)
+        )
+    except ConnectionError as exc:
+        logger.error("Connection to %s failed: %s", peer_id, str(exc))
+        logger.warning("Reverting to cached data for %s", peer_id)
+        response = None
+
+    if response is None:
+        # the cache directory has a single writer, so an unchanged size and
+        # mtime means the cached payload is the one parsed last time
+        if parsed_cache is not None and parsed_cache.signature == signature:
+            logger.debug("Cache for peer %s unchanged since last parse", peer_id)
+            return parsed_cache.peers
+        with open(cache, "rb") as cache_file:
+            payload = cache_file.read()
     else:
-        response = requests.get(source, timeout=REQUESTS_TIMEOUT)
         response.raise_for_status()
-        payload = response.text
-
-    if payload_format == "json":
-        return parse_dynamic_config_json(peer_id, payload)
-    elif payload_format == "xml":
-        return parse_dynamic_config_xml(peer_id, payload)
+        payload = response.content
+        if payload == read_cache(cache):
+            logger.debug("%s unchanged, keeping cached data", source)
+            os.utime(cache)
+        else:
+            with open(cache, "wb") as cache_file:
+                cache_file.write(payload)
+        if "ETag" in response.headers:
+            with open(etag_cache, "wt") as cache_file:
+                cache_file.write(response.headers["ETag"])
+        elif etag is not None:
+            os.remove(etag_cache)
+
+    digest = hashlib.sha256(payload).hexdigest()
+    if parsed_cache is not None and parsed_cache.digest == digest:
+        logger.debug("Using previously parsed config for peer %s", peer_id)
+        peers = parsed_cache.peers
     else:
-        raise ValueError("Invalid format: " + payload_format)
+        peers = parse_dynamic_config(peer_id, payload, payload_format)
+
+    signature = cache_signature(cache)
+    if (
+        parsed_cache is None
+        or parsed_cache.digest != digest
+        or parsed_cache.signature != signature
+    ):
+        save_parsed_cache(
+            parsed_cache_file,
+            ParsedCache(digest=digest, signature=signature, peers=peers),
+        )
+    return peers
 
 
 def save_config(
@@ -275,33 +426,53 @@ def save_config(
     template: Optional[str] = None,
     acl: Optional[str] = None,
 ) -> bool:
-    config_output = io.StringIO()
-    with redirect_stdout(config_output):
-        if output_format == "nsd":
-            generate_nsd(peers, use_zonefiles)
-        elif output_format == "knot":
-            generate_knot(peers, template, acl)
-        else:
-            raise ValueError("Invalid output format")
-    output_file, output_path = mkstemp(prefix="conf.", suffix=".tmp", dir=".")
-    os.write(output_file, config_output.getvalue().encode())
-    os.close(output_file)
-    os.chmod(output_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-
-    args = ["diff", "-u", filename, output_path]
-    logging.debug("Running diff: %s", " ".join(args))
-    res = subprocess.run(args, stdout=subprocess.PIPE, text=True)
-    logging.debug("diff returned %d", res.returncode)
-    if res.returncode == 0 and not force_output:
-        os.remove(output_path)
+    config_output: List[str] = []
+    if output_format == "nsd":
+        generate_nsd(peers, config_output, use_zonefiles)
+    elif output_format == "knot":
+        generate_knot(peers, config_output, template, acl)
+    else:
+        raise ValueError("Invalid output format")
+    payload = "".join(config_output).encode()
+
+    try:
+        with open(filename, "rb") as current_file:
+            current: Optional[bytes] = current_file.read()
+    except FileNotFoundError:
+        current = None
+
+    if payload == current and not force_output:
         logging.info("No change")
         return False
 
-    if res.stdout:
-        for line in res.stdout.splitlines():
-            logging.info("diff: %s", line.rstrip())
+    if diff and payload != current:
+        diff_lines = difflib.unified_diff(
+            (current or b"").decode(errors="replace").splitlines(),
+            payload.decode().splitlines(),
+            filename,
+            filename,
+            lineterm="",
+        )
+        for line in diff_lines:
+            logging.info("diff: %s", line)
+
+    output_path = f"{filename}.{secrets.token_hex(8)}.tmp"
+    output_file = os.open(
+        output_path,
+        os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+        stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH,
+    )
+    try:
+        try:
+            os.write(output_file, payload)
+            os.fsync(output_file)
+        finally:
+            os.close(output_file)
+        os.replace(output_path, filename)
+    except BaseException:
+        os.remove(output_path)
+        raise
 
-    os.rename(output_path, filename)
     logger.info("Wrote output to %s", filename)
     return True
 
@@ -333,30 +504,56 @@ def main() -> None:
         logging.basicConfig(level=logging.DEBUG)
 
     with open(args.config) as config_file:
-        config = yaml.safe_load(config_file)
+        config = yaml.load(config_file, Loader=SafeLoader)
     voluptuous.humanize.validate_with_humanized_errors(config, CONFIG_SCHEMA)
 
-    peers = []
-    for peer_id, peer_config in config.get("peers", {}).items():
-        ext = peer_config["format"]
-        if config.get("cache_dir") is not None:
-            cache = os.path.join(config.get("cache_dir"), f"{peer_id}.{ext}")
-        else:
-            cache = None
+    peers_config = config.get("peers", {})
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(MAX_WORKERS, len(peers_config)))
+    ) as executor:
+        futures = {}
+        for peer_id, peer_config in peers_config.items():
+            ext = peer_config["format"]
+            if config.get("cache_dir") is not None:
+                cache = os.path.join(config.get("cache_dir"), f"{peer_id}.{ext}")
+            else:
+                cache = None
 
-        try:
-            p = process_dper(
+            futures[peer_id] = executor.submit(
+                process_dper,
+                session=session,
                 peer_id=peer_id,
                 source=peer_config["source"],
                 cache=cache,
                 force_cache=args.offline,
                 payload_format=peer_config["format"],
             )
-        except ConnectionError as exc:
-            logger.error("Connection to %s failed: %s", peer_id, str(exc))
-            sys.exit(-1)
 
-        peers.extend(p)
+        # collect results in configuration order to keep the output stable
+        peers = []
+        failed = False
+        try:
+            for peer_id, future in futures.items():
+                try:
+                    p = future.result()
+                except ConnectionError as exc:
+                    logger.error("Connection to %s failed: %s", peer_id, str(exc))
+                    failed = True
+                    break
+
+                peers.extend(p)
+        finally:
+            # on any failure, do not start fetches that are still queued
+            for future in futures.values():
+                future.cancel()
+
+    if failed:
+        sys.exit(-1)
 
     check_peers(peers)
     changed = save_config(
@@ -373,8 +570,8 @@ def main() -> None:
     reconfigure = config.get("reconfigure_command")
     if changed and reconfigure:
         logging.info("reconfiguring using %s", reconfigure)
-        args = shlex.split(reconfigure)
-        res = subprocess.run(args, stdout=subprocess.PIPE, text=True)
+        reconfigure_args = shlex.split(reconfigure)
+        res = subprocess.run(reconfigure_args, stdout=subprocess.PIPE, text=True)
         if res.returncode:
             logging.error("reconfigure_command returned non-zero")
             log_func = logging.warning